@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 """
 A script for running our stress tests repeatedly to see if any fail.
 
@@ -15,27 +15,33 @@ tests once a day.
 """
 
 import logging
+import logging.handlers
+import multiprocessing
 import os
 import re
+import select
 import stat
 import sys
 import time
 
+from collections import ChainMap
+from concurrent.futures import ThreadPoolExecutor, wait
 from email.mime.text import MIMEText
-from glob import glob
+from heapq import heappop, heappush
+from itertools import count, product
 from logging import debug, info, warning, error, exception
 from optparse import OptionGroup, OptionParser
-from Queue import Queue
+from queue import Queue
 from random import randrange, shuffle
 from resource import setrlimit, RLIMIT_CORE
-from shutil import copy, copytree, move, rmtree
+from shutil import copytree, move, rmtree, which
 from signal import signal, SIGHUP, SIGINT, SIGPIPE, SIGALRM, SIGTERM
 from smtplib import SMTP
 from socket import gethostname
-from subprocess import call, Popen, PIPE, STDOUT
-from traceback import format_exc
+from subprocess import call, check_call, Popen, PIPE, STDOUT
+from traceback import format_exc, format_exception
 from tempfile import mkdtemp, mkstemp
-from threading import Event, Thread, Timer
+from threading import Condition, Event, Thread, Timer
 
 __version__   = '$Id$'
 __copyright__ = """Copyright (c) 2007-2012 Tokutek Inc.  All rights reserved.
@@ -104,6 +110,19 @@ def setlimits():
     setrlimit(RLIMIT_CORE, (-1, -1))
     os.nice(7)
 
+def clone_tree(src, dst):
+    # cp shares extents with src on filesystems that support reflinks
+    # (btrfs, xfs), so this is mostly metadata work.  We don't hardlink:
+    # the tests rewrite their dictionaries in place, which would corrupt
+    # the saved copy.
+    devnull = open(os.devnull, 'w')
+    r = call(['cp', '-a', '--reflink=auto', src, dst], stdout=devnull, stderr=STDOUT)
+    devnull.close()
+    if r != 0:
+        debug('cp --reflink=auto %s failed, falling back to copytree.', src)
+        rmtree(dst, ignore_errors=True)
+        copytree(src, dst)
+
 class TestFailure(Exception):
     pass
 
@@ -111,7 +130,7 @@ class Killed(Exception):
     pass
 
 class TestRunnerBase(object):
-    def __init__(self, scheduler, builddir, rev, execf, tsize, csize, default_test_time, savedir):
+    def __init__(self, scheduler, builddir, rev, execf, tsize, csize, default_test_time, savedir, runs_parent, tar_prepared, env):
         self.scheduler = scheduler
         self.builddir = builddir
         self.rev = rev
@@ -121,14 +140,19 @@ class TestRunnerBase(object):
         self.default_test_time = default_test_time
         self.long_test_index = randrange(16)
         self.savedir = savedir
+        self.runs_parent = runs_parent
+        self.tar_prepared = tar_prepared
 
-        self.env = os.environ
+        self.env = env
 
         self.nruns = 0
         self.num_ptquery = 1
         self.num_update = 1
         self.rundir = None
         self.outf = None
+        self.commandsf = None
+        self.prepare_argv = None
+        self.test_argv = None
         self.times = [0, 0]
         self.is_large = (tsize >= 10000000)
         self.oldversionstr = 'noupgrade'
@@ -140,15 +164,17 @@ class TestRunnerBase(object):
     def __getitem__(self, k):
         return self.__getattribute__(k)
 
+    infofmt = '\t'.join(['%(execf)s',
+                         '%(rev)s',
+                         '%(tsize)d',
+                         '%(csize)d',
+                         '%(oldversionstr)s',
+                         '%(num_ptquery)d',
+                         '%(num_update)d',
+                         '%(time)d'])
+
     def infostr(self):
-        return '\t'.join(['%(execf)s',
-                          '%(rev)s',
-                          '%(tsize)d',
-                          '%(csize)d',
-                          '%(oldversionstr)s',
-                          '%(num_ptquery)d',
-                          '%(num_update)d',
-                          '%(time)d']) % self
+        return self.infofmt % self
 
     @property
     def time(self):
@@ -171,12 +197,22 @@ class TestRunnerBase(object):
     @property
     def prepareloc(self):
         preparename = 'dir.%(execf)s-%(tsize)d-%(csize)d' % self
+        if self.tar_prepared:
+            preparename += '.tar.gz'
         return os.path.join(self.builddir, 'src', 'tests', preparename)
 
     def prepare(self):
-        if os.path.isdir(self.prepareloc):
+        # the arguments only change between runs, build them once here
+        # rather than every time we spawn a child
+        self.prepare_argv = self.prepareargs
+        self.test_argv = self.testargs
+        if self.tar_prepared and os.path.isfile(self.prepareloc):
+            debug('%s found existing environment tarball.', self)
+            check_call(['tar', '--use-compress-program=pigz', '-xf', self.prepareloc,
+                        '-C', self.rundir])
+        elif not self.tar_prepared and os.path.isdir(self.prepareloc):
             debug('%s found existing environment.', self)
-            copytree(self.prepareloc, self.envdir)
+            clone_tree(self.prepareloc, self.envdir)
         else:
             debug('%s preparing an environment.', self)
             self.run_prepare()
@@ -184,7 +220,15 @@ class TestRunnerBase(object):
 
     def save_prepared_envdir(self):
         debug('%s copying environment to %s.', self, self.prepareloc)
-        copytree(self.envdir, self.prepareloc)
+        if self.tar_prepared:
+            # write to a temporary name so a killed save never leaves a
+            # truncated tarball for the next run to extract
+            tmpname = '%s.tmp.%d' % (self.prepareloc, os.getpid())
+            check_call(['tar', '--use-compress-program=pigz', '-cf', tmpname,
+                        '-C', self.rundir, os.path.basename(self.envdir)])
+            os.rename(tmpname, self.prepareloc)
+        else:
+            clone_tree(self.envdir, self.prepareloc)
 
     def run(self):
         if self.nruns % 2 < 1:
@@ -196,12 +240,12 @@ class TestRunnerBase(object):
         else:
             self.num_update = randrange(16)
 
-        srctests = os.path.join(self.builddir, 'src', 'tests')
-        self.rundir = mkdtemp(dir=srctests)
+        self.rundir = mkdtemp(dir=self.runs_parent)
 
         try:
             outname = os.path.join(self.rundir, 'output.txt')
             self.outf = open(outname, 'w')
+            self.commandsf = open(os.path.join(self.rundir, 'commands.txt'), 'w', buffering=1 << 16)
 
             try:
                 self.prepare()
@@ -220,6 +264,7 @@ class TestRunnerBase(object):
                 savedir = mkdtemp(dir=self.savedir, prefix=savepfx)
                 tarfile = '%s.tar' % savedir
                 commands = ''
+                self.commandsf.flush()
                 try:
                     f = open(os.path.join(self.rundir, 'commands.txt'))
                     commands = f.read()
@@ -241,49 +286,60 @@ class TestRunnerBase(object):
                 self.scheduler.report_success(self)
         finally:
             self.outf.close()
-            rmtree(self.rundir)
+            self.commandsf.close()
+            self.scheduler.discard(self.rundir)
             self.rundir = None
             self.times = [0, 0]
             self.nruns += 1
 
     def save(self, savedir, tarfile):
-        def targetfor(path):
-            return os.path.join(savedir, os.path.basename(path))
-
-        for f in glob(os.path.join(self.rundir, '*')):
-            if os.path.isdir(f):
-                copytree(f, targetfor(f))
-            else:
-                copy(f, targetfor(f))
         fullexecf = os.path.join(self.builddir, 'src', 'tests', self.execf)
-        copy(fullexecf, targetfor(fullexecf))
-
-        # TODO: Leif was lazy and did this in bash, it should be done in python for portability
-        os.system("for l in $(ldd %(fullexecf)s | sed 's/\ *(0x[0-9a-f]*)$//;s/.*=>\ \?//;s/^\ *|\ *$//' | grep -v '^$'); do mkdir -p %(savedir)s/$(dirname $l); cp $l %(savedir)s/$l; done" % {'fullexecf': fullexecf, 'savedir': savedir})
-
-        r = call(['tar', 'cf', os.path.basename(tarfile), os.path.basename(savedir)], cwd=os.path.dirname(savedir))
-        if r != 0:
-            error('tarring up %s failed.' % savedir)
-            sys.exit(r)
+        check_call(['cp', '-a', '--reflink=auto', os.path.join(self.rundir, '.'), fullexecf, savedir])
+
+        # save the shared libraries the test was linked against, under
+        # their full paths inside savedir
+        proc = Popen(['ldd', fullexecf], stdout=PIPE, universal_newlines=True)
+        (out, err) = proc.communicate()
+        libs = []
+        for line in out.splitlines():
+            lib = re.sub(r'\s*\(0x[0-9a-f]*\)$', '', line).split('=>')[-1].strip()
+            if lib.startswith('/'):
+                libs.append(lib)
+        if len(libs) > 0:
+            check_call(['cp', '--reflink=auto', '--parents'] + libs + [savedir])
+
+        # raises on failure, which the worker reports and stops on
+        check_call(['tar', 'cf', os.path.basename(tarfile), os.path.basename(savedir)], cwd=os.path.dirname(savedir))
         os.chmod(tarfile, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
 
     def waitfor(self, proc):
-        while proc.poll() is None:
-            self.scheduler.stopping.wait(1)
-            if self.scheduler.stopping.isSet():
-                os.kill(proc.pid, SIGTERM)
-                raise Killed()
+        try:
+            pidfd = os.pidfd_open(proc.pid)
+        except (AttributeError, OSError):
+            # no pidfd support (python < 3.9 or linux < 5.3), poll instead
+            while proc.poll() is None:
+                self.scheduler.stopping.wait(1)
+                if self.scheduler.stopping.is_set():
+                    os.kill(proc.pid, SIGTERM)
+                    raise Killed()
+            return
+        try:
+            # sleep until either the child exits or the scheduler stops
+            (r, w, x) = select.select([pidfd, self.scheduler.stop_rfd], [], [])
+        finally:
+            os.close(pidfd)
+        if pidfd not in r:
+            os.kill(proc.pid, SIGTERM)
+            raise Killed()
+        proc.wait()
 
     def spawn_child(self, args):
         logging.debug('%s spawning %s', self, ' '.join([self.execf] + args))
-        commandsf = open(os.path.join(self.rundir, 'commands.txt'), 'a')
-        print >>commandsf, ' '.join([self.execf] + args)
-        commandsf.close()
+        self.commandsf.write(' '.join([self.execf] + args) + '\n')
         proc = Popen([self.execf] + args,
-                     executable=os.path.join('..', self.execf),
+                     executable=os.path.join(self.builddir, 'src', 'tests', self.execf),
                      env=self.env,
                      cwd=self.rundir,
-                     preexec_fn=setlimits,
                      stdout=self.outf,
                      stderr=STDOUT)
         self.waitfor(proc)
@@ -312,26 +368,26 @@ class TestRunnerBase(object):
 class TestRunner(TestRunnerBase):
     def run_prepare(self):
         self.phase = "create"
-        if self.spawn_child(['--only_create'] + self.prepareargs) != 0:
+        if self.spawn_child(['--only_create'] + self.prepare_argv) != 0:
             raise TestFailure('%s crashed during --only_create.' % self.execf)
 
     def run_test(self):
         self.phase = "stress"
-        if self.spawn_child(['--only_stress'] + self.testargs) != 0:
+        if self.spawn_child(['--only_stress'] + self.test_argv) != 0:
             raise TestFailure('%s crashed during --only_stress.' % self.execf)
 
 class RecoverTestRunner(TestRunnerBase):
     def run_prepare(self):
         self.phase = "create"
-        if self.spawn_child(['--only_create', '--test'] + self.prepareargs) != 0:
+        if self.spawn_child(['--only_create', '--test'] + self.prepare_argv) != 0:
             raise TestFailure('%s crashed during --only_create --test.' % self.execf)
 
     def run_test(self):
         self.phase = "test"
-        if self.spawn_child(['--only_stress', '--test'] + self.testargs) == 0:
+        if self.spawn_child(['--only_stress', '--test'] + self.test_argv) == 0:
             raise TestFailure('%s did not crash during --only_stress --test' % self.execf)
         self.phase = "recover"
-        if self.spawn_child(['--recover'] + self.prepareargs) != 0:
+        if self.spawn_child(['--recover'] + self.prepare_argv) != 0:
             raise TestFailure('%s crashed during --recover' % self.execf)
 
 class UpgradeTestRunnerMixin(TestRunnerBase):
@@ -358,7 +414,7 @@ class UpgradeTestRunnerMixin(TestRunnerBase):
 
     def run_prepare(self):
         self.phase = "create"
-        copytree(self.old_envdir, self.envdir)
+        clone_tree(self.old_envdir, self.envdir)
 
 class DoubleTestRunnerMixin(TestRunnerBase):
     """Runs the test phase twice in a row.
@@ -383,89 +439,164 @@ class DoubleUpgradeTestRunner(DoubleTestRunnerMixin, UpgradeTestRunner):
 class DoubleUpgradeRecoverTestRunner(DoubleTestRunnerMixin, UpgradeRecoverTestRunner):
     pass
 
-class Worker(Thread):
-    def __init__(self, scheduler):
-        super(Worker, self).__init__()
-        self.scheduler = scheduler
-
-    def run(self):
-        debug('%s starting.' % self)
-        while not self.scheduler.stopping.isSet():
-            test_runner = self.scheduler.get()
-            if test_runner.is_large:
-                if self.scheduler.nlarge + 1 > self.scheduler.maxlarge:
-                    debug('%s pulled a large test, but there are already %d running.  Putting it back.',
-                          self, self.scheduler.nlarge)
-                    self.scheduler.put(test_runner)
-                    continue
-                self.scheduler.nlarge += 1
-            try:
-                test_runner.run()
-            except Exception, e:
-                exception('Fatal error in worker thread.')
-                info('Killing all workers.')
-                self.scheduler.error = format_exc()
-                self.scheduler.stop()
-            if test_runner.is_large:
-                self.scheduler.nlarge -= 1
-            if not self.scheduler.stopping.isSet():
-                self.scheduler.put(test_runner)
-        debug('%s exiting.' % self)
-
-class Scheduler(Queue):
+class Scheduler(object):
     def __init__(self, nworkers, maxlarge, logger, email, branch):
-        Queue.__init__(self)
         info('Initializing scheduler with %d jobs.', nworkers)
         self.nworkers = nworkers
-        self.logger = logger
+        # ready runners, ordered by (nruns, tsize) so every runner gets a
+        # turn each round and the small ones in a round go first.  Large
+        # ones get their own heap so a worker can skip past them while
+        # maxlarge of them are already running.
+        self.ready = Condition()
+        self.small = []
+        self.large = []
+        self.seq = count()
         self.maxlarge = maxlarge
-        self.nlarge = 0  # not thread safe, don't really care right now
+        self.nlarge = 0
+        self.logger = logger
         self.passed = 0
         self.failed = 0
-        self.workers = []
+        self.executor = None
         self.stopping = Event()
+        # becomes readable when stop() is called, so waitfor() can
+        # select() on it alongside the child's pidfd
+        (self.stop_rfd, self.stop_wfd) = os.pipe()
+        os.set_blocking(self.stop_rfd, False)
         self.timer = None
+        # rundirs waiting to be deleted, so workers don't spend their
+        # time in rmtree
+        self.trash = Queue()
+        self.janitor = Thread(target=self.reap)
+        self.janitor.daemon = True
+        self.janitor.start()
         self.error = None
         self.email = email
         self.branch = branch
 
+    def work(self, i):
+        debug('Worker %d starting.', i)
+        try:
+            while not self.stopping.is_set():
+                test_runner = self.get()
+                if test_runner is None:
+                    break
+                try:
+                    test_runner.run()
+                except BaseException:
+                    # stop before done() requeues the runner, so no idle
+                    # worker picks up new work during the shutdown
+                    self.fail()
+                finally:
+                    self.done(test_runner)
+        except BaseException:
+            # something broke in get() or done(), stop the rest too, so
+            # run() isn't left waiting on workers that will never exit
+            self.fail()
+        debug('Worker %d exiting.', i)
+
+    def fail(self):
+        # even a sys.exit from a worker takes the whole scheduler down
+        exception('Fatal error in worker thread.')
+        info('Killing all workers.')
+        self.error = format_exc()
+        self.stop()
+
+    def push(self, runner):
+        # caller holds self.ready
+        heap = self.large if runner.is_large else self.small
+        heappush(heap, (runner.nruns, runner.tsize, next(self.seq), runner))
+
+    def put(self, runner):
+        with self.ready:
+            self.push(runner)
+            self.ready.notify()
+
+    def get(self):
+        # returns None once we're stopping
+        with self.ready:
+            while not self.stopping.is_set():
+                can_run_large = len(self.large) > 0 and self.nlarge < self.maxlarge
+                if can_run_large and (len(self.small) == 0 or self.large[0] < self.small[0]):
+                    self.nlarge += 1
+                    return heappop(self.large)[-1]
+                if len(self.small) > 0:
+                    return heappop(self.small)[-1]
+                self.ready.wait()
+            return None
+
+    def done(self, runner):
+        # requeue even if we're stopping, the next run() after a rebuild
+        # should still have every runner
+        with self.ready:
+            if runner.is_large:
+                self.nlarge -= 1
+            self.push(runner)
+            self.ready.notify_all()
+
     def run(self, timeout):
         info('Starting workers.')
         self.stopping.clear()
-        for i in range(self.nworkers):
-            w = Worker(self)
-            self.workers.append(w)
-            w.start()
-        if timeout != 0:
-            self.timer = Timer(timeout, self.stop)
-            self.timer.start()
-        while not self.stopping.isSet():
+        try:
+            while os.read(self.stop_rfd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        with ThreadPoolExecutor(max_workers=self.nworkers) as executor:
+            self.executor = executor
+            futures = [executor.submit(self.work, i) for i in range(self.nworkers)]
+            if timeout != 0:
+                self.timer = Timer(timeout, self.stop)
+                self.timer.start()
             try:
-                for w in self.workers:
-                    if self.stopping.isSet():
-                        break
-                    w.join(timeout=1.0)
+                # every worker exits once stopping is set, and any worker
+                # that dies sets it, so this returns exactly when we stop
+                wait(futures)
             except (KeyboardInterrupt, SystemExit):
                 debug('Scheduler interrupted.  Stopping and joining threads.')
                 self.stop()
                 self.join()
                 sys.exit(0)
-        else:
             debug('Scheduler stopped by someone else.  Joining threads.')
             self.join()
-            if self.error:
-                send_mail(self.email, 'Stress tests scheduler stopped by something, on %s' % gethostname(), self.error)
-                sys.exit(77)
+        for future in futures:
+            # work() catches everything, but never mistake a worker that
+            # died some other way for a clean stop
+            e = future.exception()
+            if e is not None and self.error is None:
+                self.error = ''.join(format_exception(type(e), e, e.__traceback__))
+        if self.error:
+            send_mail(self.email, 'Stress tests scheduler stopped by something, on %s' % gethostname(), self.error)
+            sys.exit(77)
 
     def join(self):
         if self.timer is not None:
             self.timer.cancel()
-        while len(self.workers) > 0:
-            self.workers.pop().join()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        self.trash.join()
+
+    def discard(self, path):
+        self.trash.put(path)
+
+    def reap(self):
+        def report(func, path, exc_info):
+            # keep going, but don't let rundirs pile up without a word
+            warning('Could not remove %s (%s): %s', path, func.__name__, exc_info[1])
+
+        while True:
+            path = self.trash.get()
+            try:
+                rmtree(path, onerror=report)
+            finally:
+                self.trash.task_done()
 
     def stop(self):
         info('Stopping workers.')
         self.stopping.set()
+        os.write(self.stop_wfd, b'x')
+        with self.ready:
+            self.ready.notify_all()
 
     def __getitem__(self, k):
         return self.__dict__[k]
@@ -475,13 +606,15 @@ class Scheduler(Queue):
 
     def report_success(self, runner):
         self.passed += 1
-        self.logger.info('PASSED %s', runner.infostr())
-        info('%s PASSED %s', self.reportstr(), runner.infostr())
+        infostr = runner.infostr()
+        self.logger.info('PASSED %s', infostr)
+        info('%s PASSED %s', self.reportstr(), infostr)
 
     def report_failure(self, runner):
         self.failed += 1
-        self.logger.warning('FAILED %s', runner.infostr())
-        warning('%s FAILED %s', self.reportstr(), runner.infostr())
+        infostr = runner.infostr()
+        self.logger.warning('FAILED %s', infostr)
+        warning('%s FAILED %s', self.reportstr(), infostr)
 
     def email_failure(self, runner, savedtarfile, commands, output):
         if self.email is None:
@@ -547,39 +680,50 @@ def rebuild(tokudb, builddir, tokudb_data, cc, cxx, tests):
     info('Building tokudb.')
     if not os.path.exists(builddir):
         os.mkdir(builddir)
-    newenv = os.environ
+    newenv = dict(os.environ)
     newenv['CC'] = cc
     newenv['CXX'] = cxx
-    r = call(['cmake',
-              '-DCMAKE_BUILD_TYPE=Debug',
-              '-DUSE_GTAGS=OFF',
-              '-DUSE_CTAGS=OFF',
-              '-DUSE_ETAGS=OFF',
-              '-DUSE_CSCOPE=OFF',
-              '-DTOKUDB_DATA=%s' % tokudb_data,
-              tokudb],
+    cmake_args = ['-DCMAKE_BUILD_TYPE=Debug',
+                  '-DUSE_GTAGS=OFF',
+                  '-DUSE_CTAGS=OFF',
+                  '-DUSE_ETAGS=OFF',
+                  '-DUSE_CSCOPE=OFF',
+                  '-DTOKUDB_DATA=%s' % tokudb_data]
+    if which('ccache') is not None:
+        # rebuilds after a pull only recompile what changed
+        cmake_args += ['-DCMAKE_C_COMPILER_LAUNCHER=ccache',
+                       '-DCMAKE_CXX_COMPILER_LAUNCHER=ccache']
+    r = call(['cmake'] + cmake_args + [tokudb],
              env=newenv,
              cwd=builddir)
     if r != 0:
         send_mail(['leif@tokutek.com'], 'Stress tests on %s failed to build.' % gethostname(), '')
         error('Building the tests failed.')
         sys.exit(r)
-    r = call(['make', '-j8'], cwd=builddir)
+    r = call(['make', '-s', '-j', str(multiprocessing.cpu_count())] + tests, cwd=builddir)
     if r != 0:
         send_mail(['leif@tokutek.com'], 'Stress tests on %s failed to build.' % gethostname(), '')
         error('Building the tests failed.')
         sys.exit(r)
 
 def revfor(tokudb):
-    proc = Popen("git describe --tags",
-                 shell=True, cwd=tokudb, stdout=PIPE)
+    proc = Popen(['git', 'describe', '--tags'],
+                 cwd=tokudb, stdout=PIPE,
+                 universal_newlines=True)
     (out, err) = proc.communicate()
     rev = out.strip()
     info('Using tokudb at r%s.', rev)
     return rev
 
 def main(opts):
-    builddir = os.path.join(opts.tokudb, 'build')
+    # the children inherit these, so we don't need a preexec_fn, which
+    # would force subprocess to fork() the whole harness for every spawn
+    # instead of using vfork()
+    setlimits()
+
+    # absolute, since children are started from inside their rundir,
+    # which may not be anywhere near the build
+    builddir = os.path.abspath(os.path.join(opts.tokudb, 'build'))
     if opts.build:
         rebuild(opts.tokudb, builddir, opts.tokudb_data, opts.cc, opts.cxx, opts.testnames + opts.recover_testnames)
     rev = revfor(opts.tokudb)
@@ -587,16 +731,28 @@ def main(opts):
     if not os.path.exists(opts.savedir):
         os.mkdir(opts.savedir)
 
+    if opts.runs_parent is None:
+        opts.runs_parent = os.path.join(builddir, 'src', 'tests')
+    opts.runs_parent = os.path.abspath(opts.runs_parent)
+    os.makedirs(opts.runs_parent, exist_ok=True)
+
     logger = logging.getLogger('stress')
     logger.propagate = False
     logger.setLevel(logging.INFO)
-    logger.addHandler(logging.FileHandler(opts.log))
+    # workers only enqueue records, the listener thread does the file I/O
+    logqueue = Queue()
+    logger.addHandler(logging.handlers.QueueHandler(logqueue))
+    listener = logging.handlers.QueueListener(logqueue, logging.FileHandler(opts.log))
+    listener.start()
 
     info('Saving pass/fail logs to %s.', opts.log)
     info('Saving failure environments to %s.', opts.savedir)
 
     scheduler = Scheduler(opts.jobs, opts.maxlarge, logger, opts.email, opts.branch)
 
+    # one copy for all the runners, nothing modifies it
+    env = dict(os.environ)
+
     runners = []
     for tsize in [2000, 200000, 50000000]:
         for csize in [50 * tsize, 1000 ** 3]:
@@ -607,56 +763,46 @@ def main(opts):
                 'tsize': tsize,
                 'csize': csize,
                 'default_test_time': opts.test_time,
-                'savedir': opts.savedir
+                'savedir': opts.savedir,
+                'runs_parent': opts.runs_parent,
+                'tar_prepared': opts.tar_prepared,
+                'env': env
                 }
-            for test in opts.testnames:
-                if opts.run_non_upgrade:
-                    runners.append(TestRunner(execf=test, **kwargs))
-
+            if opts.run_non_upgrade:
+                runners.extend(TestRunner(execf=test, **kwargs)
+                               for test in opts.testnames)
+                runners.extend(RecoverTestRunner(execf=test, **kwargs)
+                               for test in opts.recover_testnames)
+
+            if not opts.run_upgrade:
+                continue
+            upgrade_base = ChainMap({'old_environments_dir': opts.old_environments_dir}, kwargs)
+            versions = product(opts.old_versions, ['pristine', 'stressed'])
+            for test, (version, pristine_or_stressed) in product(opts.testnames, versions):
                 # never run test_stress_openclose.tdb on existing
                 # environments, it doesn't want them
-                if opts.run_upgrade and test != 'test_stress_openclose.tdb':
-                    for version in opts.old_versions:
-                        for pristine_or_stressed in ['pristine', 'stressed']:
-                            upgrade_kwargs = {
-                                'old_environments_dir': opts.old_environments_dir,
-                                'version': version,
-                                'pristine_or_stressed': pristine_or_stressed
-                                }
-                            upgrade_kwargs.update(kwargs)
-                            # skip running test_stress4.tdb on any env
-                            # that has already been stressed, as that
-                            # breaks its assumptions
-                            if opts.double_upgrade and test != 'test_stress4.tdb':
-                                runners.append(DoubleUpgradeTestRunner(
-                                        execf=test,
-                                        **upgrade_kwargs))
-                            elif not (test == 'test_stress4.tdb' and pristine_or_stressed == 'stressed'):
-                                runners.append(UpgradeTestRunner(
-                                        execf=test,
-                                        **upgrade_kwargs))
-
-            for test in opts.recover_testnames:
-                if opts.run_non_upgrade:
-                    runners.append(RecoverTestRunner(execf=test, **kwargs))
-
-                if opts.run_upgrade:
-                    for version in opts.old_versions:
-                        for pristine_or_stressed in ['pristine', 'stressed']:
-                            upgrade_kwargs = {
-                                'old_environments_dir': opts.old_environments_dir,
-                                'version': version,
-                                'pristine_or_stressed': pristine_or_stressed
-                                }
-                            upgrade_kwargs.update(kwargs)
-                            if opts.double_upgrade:
-                                runners.append(DoubleUpgradeRecoverTestRunner(
-                                        execf=test,
-                                        **upgrade_kwargs))
-                            else:
-                                runners.append(UpgradeRecoverTestRunner(
-                                        execf=test,
-                                        **upgrade_kwargs))
+                if test == 'test_stress_openclose.tdb':
+                    continue
+                upgrade_kwargs = ChainMap({'version': version,
+                                           'pristine_or_stressed': pristine_or_stressed},
+                                          upgrade_base)
+                # skip running test_stress4.tdb on any env
+                # that has already been stressed, as that
+                # breaks its assumptions
+                if opts.double_upgrade and test != 'test_stress4.tdb':
+                    runners.append(DoubleUpgradeTestRunner(execf=test, **upgrade_kwargs))
+                elif not (test == 'test_stress4.tdb' and pristine_or_stressed == 'stressed'):
+                    runners.append(UpgradeTestRunner(execf=test, **upgrade_kwargs))
+
+            versions = product(opts.old_versions, ['pristine', 'stressed'])
+            for test, (version, pristine_or_stressed) in product(opts.recover_testnames, versions):
+                upgrade_kwargs = ChainMap({'version': version,
+                                           'pristine_or_stressed': pristine_or_stressed},
+                                          upgrade_base)
+                if opts.double_upgrade:
+                    runners.append(DoubleUpgradeRecoverTestRunner(execf=test, **upgrade_kwargs))
+                else:
+                    runners.append(UpgradeRecoverTestRunner(execf=test, **upgrade_kwargs))
 
     shuffle(runners)
 
@@ -676,10 +822,12 @@ def main(opts):
                 runner.rev = rev
     except (KeyboardInterrupt, SystemExit):
         sys.exit(0)
-    except Exception, e:
+    except Exception as e:
         exception('Unhandled exception caught in main.')
         send_mail(['leif@tokutek.com'], 'Stress tests caught unhandled exception in main, on %s' % gethostname(), format_exc())
         raise e
+    finally:
+        listener.stop()
 
 if __name__ == '__main__':
     a0 = os.path.abspath(sys.argv[0])
@@ -693,6 +841,8 @@ if __name__ == '__main__':
     parser.add_option('-s', '--savedir', type='string', dest='savedir',
                       default='/tmp/run.stress-tests.failures',
                       help='where to save environments and extra data for failed tests')
+    parser.add_option('--rundir', type='string', dest='runs_parent', metavar='RUNDIR', default=None,
+                      help='where to create the working directory for each test run, e.g. a tmpfs like /dev/shm/run.stress-tests [default=build/src/tests]')
     parser.add_option('--email', action='append', type='string', dest='email', default=[], help='where to send emails')
     parser.add_option('--no-email', action='store_false', dest='send_emails', default=True, help='suppress emails on failure')
     default_toplevel = os.path.dirname(os.path.dirname(a0))
@@ -722,6 +872,8 @@ if __name__ == '__main__':
                           help='how many concurrent tests to run [default=8]')
     test_group.add_option('--maxlarge', type='int', dest='maxlarge', default=2,
                           help='maximum number of large tests to run concurrently (helps prevent swapping) [default=2]')
+    test_group.add_option('--tar_prepared', action='store_true', dest='tar_prepared', default=False,
+                          help='cache prepared environments as pigz-compressed tarballs instead of directories, saves space where reflinks are not supported [default=False]')
     parser.add_option_group(test_group)
 
 
@@ -780,6 +932,9 @@ if __name__ == '__main__':
     if opts.old_versions is not None and len(opts.old_versions) > 0:
         opts.run_upgrade = True
 
+    if opts.tar_prepared and which('pigz') is None:
+        parser.error('You specified --tar_prepared but pigz is not in your PATH.')
+
     if opts.run_upgrade:
         if not os.path.isdir(opts.old_environments_dir):
             parser.error('You specified --run_upgrade but did not specify an --old_environments_dir that exists.')